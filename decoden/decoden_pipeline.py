@@ -37,6 +37,8 @@ def _decoden_pipeline(pipeline_steps,
                       chunk_size=None,
                       seed=None,
                       plotting=None,
+                      nmf_n_jobs=1,
+                      n_outer_jobs=1,
                       
                       # Peak calling arguments
                       pval_alpha=None,
@@ -69,7 +71,9 @@ def _decoden_pipeline(pipeline_steps,
                                                                         n_train_bins=n_train_bins, 
                                                                         chunk_size=chunk_size, 
                                                                         seed=seed,
-                                                                        plotting=plotting)
+                                                                        plotting=plotting,
+                                                                        n_jobs=nmf_n_jobs,
+                                                                        n_outer_jobs=n_outer_jobs)
         
     if "hsr" in pipeline_steps:
         assert "nmf" in pipeline_steps, "HSR requires NMF as a starting step"
@@ -1,10 +1,34 @@
+import math
 import numpy as np
-from sklearn.linear_model import LinearRegression
+import pandas as pd
+from numba import njit
 from tqdm import tqdm
 import warnings
 from decoden.constants import UNSPECIFIC_SIGNAL_LABEL
 
 
+@njit(fastmath=True, cache=True)
+def _hsr_kernel(control_transf, treatment_transf, slope, log_clip):
+    """Compute the HSR track in a single pass over the log-transformed signals. The kernel is
+    serial so that it does not start its own thread pool next to concurrent jobs
+
+    Args:
+        control_transf (np.array): log-transformed unspecific signal
+        treatment_transf (np.array): log-transformed treatment signal
+        slope (float): regression coefficient of the treatment on the control
+        log_clip (float): lower bound for the log-prediction
+
+    Returns:
+        np.array: HSR track
+    """
+    n = control_transf.shape[0]
+    track = np.empty(n)
+    for i in range(n):
+        lp = max(slope * control_transf[i], log_clip)
+        track[i] = math.exp(treatment_transf[i] - lp)
+    return track
+
+
 def run_HSR(wmat, bl_mask, conditions_list, eps=1e-20, signal_clip=0.1):
     """Run HSR step of DecoDen
 
@@ -15,34 +39,41 @@ def run_HSR(wmat, bl_mask, conditions_list, eps=1e-20, signal_clip=0.1):
         eps (_type_, optional): minimum value threshold. Defaults to 1e-20.
     """
     # control_label = conditions_list[0]
-    out_df = wmat.loc[:, []]
+    results = {}
 
-    control_transf = wmat.loc[:, UNSPECIFIC_SIGNAL_LABEL].apply(
-        lambda x: np.maximum(eps, x)).apply(np.log)
+    control_transf = np.log(np.maximum(wmat[UNSPECIFIC_SIGNAL_LABEL].to_numpy(), eps))
 
 #     control_transf -= np.mean(control_transf)
 
+    # The control track does not depend on the treatment condition: slice and summarise it once
+    bl_mask = np.asarray(bl_mask, dtype=bool)
+    ctrl_bl = control_transf[bl_mask]
+    ctrl_bl_med = np.median(ctrl_bl)
+
     for i, treatment_cond in tqdm(enumerate(conditions_list[1:])):
         # Select only values above the median for the fit, to reduce the contribution of noise
-        treatment_transf = wmat.loc[:, treatment_cond].apply(
-            lambda x: np.maximum(eps, x)).apply(np.log)
-        mean_treatment_transf = np.mean(treatment_transf)
+        treatment_transf = np.log(np.maximum(wmat[treatment_cond].to_numpy(), eps))
 #         treatment_transf -= mean_treatment_transf
+        treat_bl = treatment_transf[bl_mask]
+        treat_bl_med = np.median(treat_bl)
 
         # print warning message if median is too low
-        if (np.median(treatment_transf[bl_mask]) < 1) or (np.median(treatment_transf[bl_mask]) < 1):
+        if treat_bl_med < 1:
             warnings.warn("Treatment/Control coverage might be too low for half-sibling regression to be effective!")
 
-        fit_ixs = np.where((control_transf[bl_mask] > np.median(control_transf[bl_mask])) & (
-            treatment_transf[bl_mask] > np.median(treatment_transf[bl_mask])))[0]
-        reg = LinearRegression(fit_intercept=False).fit(
-            control_transf[bl_mask].values[fit_ixs].reshape(-1, 1), treatment_transf[bl_mask][fit_ixs])
+        fit_mask = (ctrl_bl > ctrl_bl_med) & (treat_bl > treat_bl_med)
+        # Least-squares fit through the origin with a single regressor: slope = <x, y> / <x, x>
+        x, y = ctrl_bl[fit_mask], treat_bl[fit_mask]
+        xx = float(x @ x)
+        if xx == 0:
+            raise ValueError(f"No bins available to fit the half-sibling regression for condition '{treatment_cond}'. "
+                             "Control and treatment signals are constant or zero over the non-blacklisted bins.")
+        slope = float(x @ y) / xx
 
-        log_pred = np.maximum(reg.predict(
-            control_transf.values.reshape(-1, 1)), np.log(signal_clip))
-        pred = np.exp(log_pred)
 #         track = np.exp(treatment_transf+mean_treatment_transf-log_pred)
-        track = np.exp(treatment_transf-log_pred)
-        out_df[treatment_cond+" HSR Value"] = track
+        track = _hsr_kernel(control_transf, treatment_transf, slope, np.log(signal_clip))
+        results[treatment_cond+" HSR Value"] = track
 
+    # Build the output in one go rather than inserting columns one by one
+    out_df = pd.DataFrame(results, index=wmat.index)
     return out_df
@@ -4,6 +4,8 @@ import json
 import os
 from os.path import exists, join
 from sklearn.decomposition import NMF, non_negative_factorization
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
 from tqdm import tqdm
 from pathlib import Path
 import warnings
@@ -13,6 +15,38 @@ import seaborn as sns
 from decoden.utils import get_blacklisted_regions_mask, load_files, adjust_matrices
 from decoden.constants import *
 
+def _blas_limit(n_outer_jobs):
+    """Number of BLAS threads per job when running inside `n_outer_jobs` concurrent jobs
+
+    Args:
+        n_outer_jobs (int): Number of concurrent jobs sharing the machine
+
+    Returns:
+        int: BLAS thread limit, or None to leave BLAS unlimited for a single job or an unknown CPU count
+    """
+    n_cpus = os.cpu_count()
+    if n_outer_jobs <= 1 or n_cpus is None:
+        return None
+    return max(1, n_cpus // n_outer_jobs)
+
+
+def _fit_specific_signal(data, alpha_W, alpha_H, blas_limit=None):
+    """Fit the single-component NMF of one modification's unspecific-subtracted replicates
+
+    Args:
+        data (np.array): C-contiguous block of the modification's replicate columns
+        alpha_W (float): Regularisation for the signal matrix
+        alpha_H (float): Regularisation for the mixing matrix
+        blas_limit (int, optional): Maximum number of BLAS threads. Defaults to None (no limit).
+
+    Returns:
+        tuple: (W, H, n_iter) from `non_negative_factorization`
+    """
+    with threadpool_limits(limits=blas_limit, user_api='blas'):
+        return non_negative_factorization(data, n_components=1, beta_loss=1, solver="mu",
+                                          alpha_W=alpha_W, alpha_H=alpha_H)
+
+
 def relax_mixing_matrix(data, mmat, smat, alpha_H=0.01, alpha_W=0.001):
     n_comps = len(mmat)
     mmat_1, smat_1, n_iter1 = non_negative_factorization(data.T,
@@ -28,7 +62,7 @@ def relax_mixing_matrix(data, mmat, smat, alpha_H=0.01, alpha_W=0.001):
 
 
 def extract_mixing_matrix(data_df, conditions_list, conditions_counts_ref, alpha_W=0.01, alpha_H=0.001,
-                          control_cov_threshold=1.0, n_train_bins=300000, seed=42):
+                          control_cov_threshold=1.0, n_train_bins=300000, seed=42, n_jobs=1, n_outer_jobs=1):
     """Extract mixing matrix in the NMF step of DecoDen
 
     Args:
@@ -40,96 +74,118 @@ def extract_mixing_matrix(data_df, conditions_list, conditions_counts_ref, alpha
         control_cov_threshold (float, optional): Minimum coverage for the training data for the NMF. Defaults to 1.0.
         n_train_bins (int, optional): Number of training bins for the extraction of the mixing matrix. Defaults to 300000.
         seed (int, optional): Random state for reproductibility. Defaults to 42.
+        n_jobs (int, optional): Number of parallel jobs for the per-modification NMF fits. Defaults to 1.
+        n_outer_jobs (int, optional): Number of concurrent jobs DecoDen is being run in, used to cap BLAS threads. Defaults to 1 (no cap).
 
     Returns:
         numpy.array: Mixing matrix from NMF
     """
+    # Split the columns into control and treatment samples once
+    is_ctrl = np.array([c.startswith(conditions_list[0]) for c in data_df.columns], dtype=bool)
+
     # Filter data to have sufficient control coverage
-    dsel = data_df[(data_df[[c for c in data_df.columns if c.startswith(
-        conditions_list[0])]] > control_cov_threshold).any(axis=1)]
-    train_data = dsel.sample(n_train_bins, random_state=seed)
-    
+    keep = (data_df.values[:, is_ctrl] > control_cov_threshold).any(axis=1)
+    dsel = data_df.iloc[keep]
+    # Sample the training bins across the whole genome, but keep them in genomic order so that
+    # the row gather walks memory monotonically. A single contiguous block would be cheaper still,
+    # but neighbouring bins are correlated and would not be representative of the whole genome
+    rng = np.random.default_rng(seed)
+    train_ixs = np.sort(rng.choice(len(dsel), size=n_train_bins, replace=False))
+    train_data = dsel.iloc[train_ixs]
+    # Bin coverages are small non-negative values, float32 represents them with ample precision
+    # and halves the memory traffic of the NMF updates
+    train_arr = train_data.to_numpy(dtype=np.float32)
+
+    # Cap BLAS threads around the NMF calls when running inside concurrent outer jobs
+    blas_limit = _blas_limit(n_outer_jobs)
 
     # Extract unspecific signal from control samples
     model = NMF(n_components=1, init='random', random_state=0,
                 beta_loss=1, solver="mu", alpha_W=alpha_W, alpha_H=alpha_H)
-    control_cols = [
-        c for c in data_df.columns if c.startswith(conditions_list[0])]
-    treatment_cols = [c for c in data_df.columns if c not in control_cols]
-    W_unspec = model.fit_transform(train_data.loc[:, control_cols])
+    with threadpool_limits(limits=blas_limit, user_api='blas'):
+        W_unspec = model.fit_transform(train_arr[:, is_ctrl])
     H_unspec = model.components_
 
     # Calculate unspecific signal coefficients for treatment
     # I swapped and transposed the matrices to make use of the update_H parameter
-    W_treat_uns, H_treat_uns, n_iter = non_negative_factorization(train_data.loc[:, treatment_cols].T,
-                                                                  n_components=1, init="custom",
-                                                                  H=W_unspec.reshape(1, -1), update_H=False, alpha_W=alpha_W,
-                                                                  beta_loss=1, solver="mu")
+    with threadpool_limits(limits=blas_limit, user_api='blas'):
+        W_treat_uns, H_treat_uns, n_iter = non_negative_factorization(train_arr[:, ~is_ctrl].T,
+                                                                      n_components=1, init="custom",
+                                                                      H=W_unspec.reshape(1, -1), update_H=False, alpha_W=alpha_W,
+                                                                      beta_loss=1, solver="mu")
     H_unspec_coefs = np.concatenate(
         (H_unspec.flatten(), W_treat_uns.T.flatten()))
 
     # Subtract the unspecific contribution from the data
     # Cap the minimum value to 0 to account for predictions higher than the signal
-    specific_data_mat = np.maximum(
-        train_data.values - W_unspec.dot(H_unspec_coefs.reshape(1, -1)), 0)
+    specific_data_mat = np.maximum(train_arr - W_unspec @ H_unspec_coefs[None, :], 0)
 
     # For each modification, extract the specific signal components
     treatment_conditions = conditions_list[1:]
     n_replicates = [conditions_counts_ref[c] for c in conditions_list]
     n_control_replicates = n_replicates[0]
     histone_n_replicates = n_replicates[1:]
-    signal_matrix = [W_unspec]
-    mixing_matrix = np.zeros((len(conditions_list), np.sum(n_replicates)))
+    # The per-condition signals feed the cross-condition fits and the relaxation step
+    signal_matrix = np.empty((len(train_arr), len(conditions_list)), dtype=np.float32)
+    signal_matrix[:, 0] = W_unspec[:, 0]
+    mixing_matrix = np.zeros((len(conditions_list), np.sum(n_replicates)), dtype=np.float32)
     mixing_matrix[0, :] = H_unspec_coefs
 
+    # Blocks of replicate columns belonging to each modification
+    pairs = []
     ix = n_control_replicates
+    for c in histone_n_replicates:
+        pairs.append((ix, c))
+        ix += c
 
-    cross_data_mat = []
-    for i, modif in tqdm(enumerate(treatment_conditions)):
-
-        c = histone_n_replicates[i]
-        W_spec, H_spec, n_iter = non_negative_factorization(specific_data_mat[:, ix:ix+c],
-                                                            n_components=1, beta_loss=1, solver="mu", alpha_W=alpha_W, alpha_H=alpha_H)
+    # The modifications are fitted independently of each other. Only each modification's column
+    # block is sent to the workers, as a C-contiguous copy of the strided column slice.
+    # Parallel workers run single-threaded BLAS to avoid oversubscribing the cores
+    fit_blas_limit = 1 if n_jobs != 1 else blas_limit
+    fits = Parallel(n_jobs=n_jobs, backend="loky", return_as="generator")(
+        delayed(_fit_specific_signal)(np.ascontiguousarray(specific_data_mat[:, ix:ix+c]), alpha_W, alpha_H, fit_blas_limit)
+        for ix, c in pairs)
+    results = list(tqdm(fits, total=len(pairs)))
 
+    cross_data_mat = []
+    for i, ((ix, c), (W_spec, H_spec, n_iter)) in enumerate(zip(pairs, results)):
         mixing_matrix[i+1, ix:ix+c] = H_spec
 
         cross_data_mat.append(
             np.clip(specific_data_mat[:, ix:ix+c] - W_spec.dot(H_spec), 0, None)
         )
-        signal_matrix.append(W_spec)
-        ix += c
+        signal_matrix[:, i+1] = W_spec[:, 0]
+    del results
     
-    signal_matrix = np.hstack(signal_matrix)
     cross_data_mat = np.hstack(cross_data_mat)
     ix = n_control_replicates
 
     if len(treatment_conditions) > 1:
         for i, modif in tqdm(enumerate(treatment_conditions)):
             c = histone_n_replicates[i]
-            excl_idxs = list(range(n_control_replicates)) + list(range(ix, ix+c))
-            cross_samples_idxs = np.array([i for i in range(mixing_matrix.shape[1]) if i not in excl_idxs]).astype(int)
-            
-
             cross_cond_idxs = np.array([j for j in range(len(treatment_conditions)+1) if j>0 and j!=i+1]).astype(int)
 
             cond_ix = ix - n_control_replicates
-            cross_mixing_coefs, cross_signal_mat, n_iter = non_negative_factorization(cross_data_mat.T[cond_ix:cond_ix+c,:],
-                                                                        n_components=len(cross_cond_idxs), init="custom",
-                                                                        H=signal_matrix[:,cross_cond_idxs].T , update_H=False, alpha_W=alpha_W,
-                                                                        beta_loss=1, solver="mu")
+            with threadpool_limits(limits=blas_limit, user_api='blas'):
+                cross_mixing_coefs, cross_signal_mat, n_iter = non_negative_factorization(np.ascontiguousarray(cross_data_mat.T[cond_ix:cond_ix+c,:]),
+                                                                            n_components=len(cross_cond_idxs), init="custom",
+                                                                            H=signal_matrix[:,cross_cond_idxs].T , update_H=False, alpha_W=alpha_W,
+                                                                            beta_loss=1, solver="mu")
             mixing_matrix[cross_cond_idxs, ix:ix+c] = cross_mixing_coefs.T
             ix += c
     
     # Add relaxation step, where we allow the matrices to vary jointly across modifications
-    mixing_matrix, signal_matrix = relax_mixing_matrix(train_data, mixing_matrix, signal_matrix, alpha_H=alpha_H, alpha_W=alpha_W)
+    # Only the mixing matrix is returned, the relaxed signal matrix is discarded
+    with threadpool_limits(limits=blas_limit, user_api='blas'):
+        mixing_matrix, _ = relax_mixing_matrix(train_arr, mixing_matrix, signal_matrix, alpha_H=alpha_H, alpha_W=alpha_W)
     
-    mm = pd.DataFrame(mixing_matrix, index=[
+    mm = pd.DataFrame(mixing_matrix.astype(np.float64), index=[
                       UNSPECIFIC_SIGNAL_LABEL]+treatment_conditions, columns=train_data.columns)
     
     return mm
 
 
-def extract_signal(data_df, mmatrix, conditions_list, chunk_size=100000, alpha_W=0.01, seed=42):
+def extract_signal(data_df, mmatrix, conditions_list, chunk_size=100000, alpha_W=0.01, seed=42, n_outer_jobs=1):
     """Use the mixing matrix to extract the signals. Can be done in chunks to fit in memory
 
     Args:
@@ -139,23 +195,31 @@ def extract_signal(data_df, mmatrix, conditions_list, chunk_size=100000, alpha_W
         chunk_size (int, optional): Number of genomic bins to process in one chunk. Defaults to 100000.
         alpha_W (float, optional): Regularisation for the signal matrix. Defaults to 0.01.
         seed (int, optional): Random state for reproductibility. Defaults to 42.
+        n_outer_jobs (int, optional): Number of concurrent jobs DecoDen is being run in, used to cap BLAS threads. Defaults to 1 (no cap).
 
     Returns:
         np.array: signal matrix from NMF
     """
     # Use the mixing matrix to extract the signals. Can be done in chunks to fit in memory
-    processed_W = []
-    for ck in tqdm(np.split(data_df.values, range(chunk_size, len(data_df)+chunk_size, chunk_size))):
-        if len(ck) < 1:
-            # print(ck)
-            break
-        W = np.random.uniform(0, 0.1, size=(len(ck), len(mmatrix)))
-        ck_W, H, n_iter = non_negative_factorization(ck, W, mmatrix.values,
-                                                     n_components=len(mmatrix), init='custom', random_state=seed, update_H=False,
-                                                     beta_loss="kullback-leibler", solver="mu", alpha_W=alpha_W, max_iter=500
-                                                     )
-        processed_W.append(ck_W)
-    processed_W = np.vstack(processed_W)
+    arr = data_df.values
+    n = len(arr)
+    # Chunks are written straight into the output, stored in float32 to halve its footprint
+    processed_W = np.empty((n, len(mmatrix)), dtype=np.float32)
+
+    # sklearn requires the mixing matrix to match the dtype of the data
+    H = mmatrix.values.astype(arr.dtype)
+    # Cap BLAS threads around the NMF calls when running inside concurrent outer jobs
+    blas_limit = _blas_limit(n_outer_jobs)
+    for start in tqdm(range(0, n, chunk_size)):
+        # `data_df.values` is usually column-major, so row chunks are not contiguous on their own
+        ck = np.ascontiguousarray(arr[start:start+chunk_size])
+        # With `update_H=False` sklearn initialises W itself and ignores any W passed in
+        with threadpool_limits(limits=blas_limit, user_api='blas'):
+            ck_W, _, n_iter = non_negative_factorization(ck, None, H,
+                                                         n_components=len(mmatrix), init='custom', random_state=seed, update_H=False,
+                                                         beta_loss="kullback-leibler", solver="mu", alpha_W=alpha_W, max_iter=500
+                                                         )
+        processed_W[start:start+len(ck)] = ck_W
     processed_W = pd.DataFrame(
         processed_W, index=data_df.index, columns=[UNSPECIFIC_SIGNAL_LABEL]+conditions_list[1:])
     return processed_W
@@ -171,7 +235,9 @@ def run_NMF(files_reference,
         n_train_bins=50000, 
         chunk_size=50000, 
         seed=0,
-        plotting=True):
+        plotting=True,
+        n_jobs=1,
+        n_outer_jobs=1):
     
     
     """`main` function that runs the internal pipeline for DecoDen
@@ -188,6 +254,8 @@ def run_NMF(files_reference,
         chunk_size: Chunk size for processing the signal matrix. Should be smaller than `n_train_bins`
         alpha_W: Regularisation for the signal matrix
         alpha_H: Regularisation for the mixing matrix
+        n_jobs: Number of parallel jobs for the per-modification NMF fits
+        n_outer_jobs: Number of concurrent jobs DecoDen is being run in, used to cap BLAS threads. 1 leaves BLAS uncapped
     """
 
     # validate arguments
@@ -238,10 +306,12 @@ def run_NMF(files_reference,
         # Extract mixing matrix
         mmatrix = extract_mixing_matrix(data_noBL, conditions, conditions_counts, alpha_W=alpha_W, 
                                     alpha_H=alpha_H, control_cov_threshold=control_cov_threshold, 
-                                    n_train_bins=n_train_bins, seed=seed)
+                                    n_train_bins=n_train_bins, seed=seed, n_jobs=n_jobs,
+                                    n_outer_jobs=n_outer_jobs)
         
         # Extract signal matrix
-        wmatrix = extract_signal(data, mmatrix, conditions, chunk_size=chunk_size, alpha_W=alpha_W, seed=seed)
+        wmatrix = extract_signal(data, mmatrix, conditions, chunk_size=chunk_size, alpha_W=alpha_W, seed=seed,
+                                 n_outer_jobs=n_outer_jobs)
         
         # Rescale matrixes to have comparable signals
         mmatrix, wmatrix = adjust_matrices(mmatrix, wmatrix, q=0.98)
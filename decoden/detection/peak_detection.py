@@ -75,19 +75,20 @@ def compact_df(df):
     
     peak_colname = [c for c in df.columns if "Peak" in c][0]
     pval_colname = [c for c in df.columns if "Pvalue" in c][0]
-    for i, row in df.iterrows():
+    # Iterate over the raw columns, `iterrows` would box every genomic bin into a Series
+    for i, peak, pval in zip(df.index, df[peak_colname].to_numpy(), df[pval_colname].to_numpy()):
         
-        if peak_val==row[peak_colname] and i[0]==chromosome:
+        if peak_val==peak and i[0]==chromosome:
             end = i[2]
-            if row[pval_colname]<lowest_pval:
-                lowest_pval = row[pval_colname]
+            if pval<lowest_pval:
+                lowest_pval = pval
         else:
             if chromosome is not None:
                 compacted_df.append({"seqnames": chromosome, "start": start, "end": end,
                                     peak_colname: peak_val, pval_colname: lowest_pval})
-            peak_val = int(row[peak_colname])
+            peak_val = int(peak)
             chromosome, start, end = i
-            lowest_pval = row[pval_colname]
+            lowest_pval = pval
     
     compacted_df.append({"seqnames": chromosome, "start": start, "end": end,
                                     peak_colname: peak_val, pval_colname: lowest_pval})
@@ -68,7 +68,7 @@ def preprocess(
                                 Recommended value is 10-200. Smaller bin size increases space and runtime, larger binsizes may occlude small variations. 
                                 """),
     num_jobs: int = typer.Option(
-        1, "--num_jobs", "-n", help="Number of parallel jobs for preprocessing."),
+        1, "--num_jobs", "-n", help="Number of parallel jobs for preprocessing. Treatment conditions run in threads of one process, which only overlap their `macs2 predictd` calls; read counting uses this many deeptools processes per condition."),
     out_dir: Optional[Path] = typer.Option(
         None, "--out_dir", "-o", help="Path to directory where all output files will be written"),
     genome_size: str = typer.Option(
@@ -148,7 +148,7 @@ def run(
                                 Recommended value is 10-200. Smaller bin size increases space and runtime, larger binsizes may occlude small variations. 
                                 """),
     num_jobs: int = typer.Option(
-        1, "--num_jobs", "-n", help="Number of parallel jobs for preprocessing."),
+        1, "--num_jobs", "-n", help="Number of parallel jobs for preprocessing. Treatment conditions run in threads of one process, which only overlap their `macs2 predictd` calls; read counting uses this many deeptools processes per condition."),
     out_dir: Optional[Path] = typer.Option(
         None, "--out_dir", "-o", help="Path to directory where all output files will be written"),
     genome_size: str = typer.Option(
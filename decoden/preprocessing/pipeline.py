@@ -15,14 +15,16 @@ from deeptools import bamHandler
 from deeptools.utilities import getCommonChrNames
 import pysam
 import numpy as np
+from joblib import Parallel, delayed
 from tqdm import tqdm
 
 
-def get_fragment_length(list_of_filepaths, output_dir, genome_size):
+def get_fragment_length(list_of_filepaths, output_dir, genome_size, rfile='predictd'):
     """Estimate fragment length. Internally uses `macs2 predictd`.
 
     Args:
         list_of_filepaths (list): list of strings to path to file with reads
+        rfile (str, optional): name of the R script written by `macs2 predictd` in `output_dir`. Defaults to 'predictd'.
 
     Raises:
         Exception: Unable to compute fragment length
@@ -35,7 +37,7 @@ def get_fragment_length(list_of_filepaths, output_dir, genome_size):
     for filepath in list_of_filepaths:    
         assert os.path.exists(filepath), f"File {filepath} not found"
 
-    result = subprocess.run(f'macs2 predictd -i {" ".join(list_of_filepaths)} -g {genome_size} -m 5 50 --outdir {output_dir}', capture_output=True, text=True, shell=True)
+    result = subprocess.run(f'macs2 predictd -i {" ".join(list_of_filepaths)} -g {genome_size} -m 5 50 --outdir {output_dir} --rfile {rfile}', capture_output=True, text=True, shell=True)
     try:
         fragment_length = int([s for s in result.stderr.split('\n') if 'tag size is' in s][0].split()[-2])
     except:
@@ -147,7 +149,9 @@ class Preprocessor(object):
         
         fragment_length = None
         if not is_control:
-            fragment_length = get_fragment_length(list_of_filepaths, self.out_dir, self.genome_size)
+            # Conditions can be processed concurrently, give each its own `macs2 predictd` output file
+            fragment_length = get_fragment_length(list_of_filepaths, self.out_dir, self.genome_size,
+                                                  rfile=f'{condition}_predictd')
             self.fragment_lengths[condition] = fragment_length
 
             # count reads
@@ -168,7 +172,8 @@ class Preprocessor(object):
         # save results
         save_path = join(self.out_dir, 'data', f'{condition}_reads.npy')
         logger.info(f'Saving results to {save_path}')
-        np.save(save_path, processed_reads)
+        # float32 keeps the fractional coverages and the genome background, at half the size on disk
+        np.save(save_path, processed_reads.astype(np.float32))
 
         # update experiment_conditions
         if "sample_label" in group.columns:
@@ -198,11 +203,25 @@ class Preprocessor(object):
 
         grouped = self.input_csv.groupby('exp_name')
         control_group_name = None
+        treatment_groups = []
         for condition, group in grouped:
             if 1 not in group['is_control'].unique():
-                self.preprocess_single(condition, group)
+                treatment_groups.append((condition, group))
             else:
                 control_group_name = condition
+
+        # Treatment conditions are independent of each other. Threads avoid pickling the preprocessor
+        # state into separate processes, but only the `macs2 predictd` subprocesses and file writes
+        # overlap: read counting runs deeptools' `count_reads_in_region` in-process and holds the GIL
+        # for most of its work, so that step is still largely serialised across conditions
+        Parallel(n_jobs=self.num_jobs, backend='threading')(
+            delayed(self.preprocess_single)(condition, group) for condition, group in treatment_groups)
+        # Restore a deterministic order of the conditions, independent of thread completion
+        treatment_order = [condition for condition, _ in treatment_groups]
+        self.experiment_conditions = dict(sorted(self.experiment_conditions.items(),
+                                                 key=lambda item: treatment_order.index(item[1]['condition'])))
+
+        # The control fragment length depends on the treatment fragment lengths, so it is processed last
         control = grouped.get_group(control_group_name)
         self.preprocess_single(control_group_name, control)
 
@@ -211,12 +230,14 @@ class Preprocessor(object):
 
     def check_preprocessed(self):
         # check if .npy files are present in save directory
+        try:
+            with os.scandir(join(self.out_dir, 'data')) as entries:
+                existing = {entry.name for entry in entries}
+        except FileNotFoundError:
+            return False
         for condition in self.input_csv['exp_name'].unique():
             save_path = f'{condition}_reads.npy'
-            try:
-                if save_path not in os.listdir(join(self.out_dir, 'data')):
-                    return False
-            except FileNotFoundError:
+            if save_path not in existing:
                 return False
         return True
 
@@ -242,7 +263,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', "--input_csv", required=True, help='path to CSV file with information about experimental conditions. Must contain `filepath`, `exp_name` and `is_control` columns. Control/input should be the first condition. Input files can be in BED/BAM format.')
     parser.add_argument('-bs', "--bin_size", default=200, type=int, help='size of genomic bin for tiling. Recommended value is 10-200. Smaller bin size increases space and runtime, larger binsizes may occlude small variations. Default: 200')
-    parser.add_argument('-n', "--num_jobs", default=1, type=int, help='Number of parallel jobs for preprocessing. Default: 1')
+    parser.add_argument('-n', "--num_jobs", default=1, type=int, help='Number of parallel jobs for preprocessing. Treatment conditions run in threads of one process, which only overlap their `macs2 predictd` calls; read counting uses this many deeptools processes per condition. Default: 1')
     parser.add_argument('-o', "--out_dir", required=True, help='path to directory where all output files will be written')
     parser.add_argument('-a', "--assembly", required=True, help='genome assembly')
     
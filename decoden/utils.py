@@ -40,8 +40,8 @@ def get_blacklisted_regions_mask(df, bl_regions):
     filter_ixs = None
     index_start = df.index.get_level_values("start")
     index_end = df.index.get_level_values("end")
-    for i, r in tqdm(reg.iterrows()):
-        ixs = ((index_start>=r["start"]) & (index_start<=r["end"]) | (index_end>=r["start"]) & (index_end<=r["end"]))
+    for r in tqdm(reg.itertuples(index=False)):
+        ixs = ((index_start>=r.start) & (index_start<=r.end) | (index_end>=r.start) & (index_end<=r.end))
         if filter_ixs is None:
             filter_ixs = ixs
         else:
@@ -71,8 +71,8 @@ def load_files(files_ref, data_folder, sample_conditions):
     chrom_sizes = pd.read_csv(join(data_folder, 'chrom_sizes.bed'), sep='\t', names=['chr', 'start', 'end'])
 
     seqnames, starts, ends = [], [], []
-    for _, row in chrom_sizes.iterrows():
-        chr_name, start, end = row['chr'], row['start'], row['end']
+    for row in chrom_sizes.itertuples(index=False):
+        chr_name, start, end = row.chr, row.start, row.end
         num_bins = int(np.ceil((end - start)/bin_size))
         
         seqnames.extend([chr_name] * num_bins)
@@ -83,7 +83,7 @@ def load_files(files_ref, data_folder, sample_conditions):
 
     # read in data
     for npy_file in files_ref:
-        counts = np.load(npy_file)
+        counts = np.load(npy_file).astype(np.float32, copy=False)
         condition = files_ref[npy_file]['condition']
         for i, name in enumerate(files_ref[npy_file]['sample_names']):
             data[f'{condition}_{i+1}'] = counts[:, i]
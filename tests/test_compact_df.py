@@ -0,0 +1,27 @@
+import pandas as pd
+from decoden.detection.peak_detection import compact_df
+
+
+def test_compact_df_merges_consecutive_bins():
+    index = pd.MultiIndex.from_tuples([
+        ("chr1", 0, 200),
+        ("chr1", 200, 400),
+        ("chr1", 400, 600),
+        ("chr1", 600, 800),
+        ("chr2", 0, 200),
+        ("chr2", 200, 400),
+    ], names=["seqnames", "start", "end"])
+    df = pd.DataFrame({
+        "H3K4me3 Peak": [0, 1, 1, 0, 0, 0],
+        "H3K4me3 Pvalue": [0.5, 0.01, 0.001, 0.3, 0.2, 0.4],
+    }, index=index)
+
+    result = compact_df(df)
+
+    expected = pd.DataFrame([
+        {"seqnames": "chr1", "start": 0, "end": 200, "H3K4me3 Peak": 0, "H3K4me3 Pvalue": 0.5},
+        {"seqnames": "chr1", "start": 200, "end": 600, "H3K4me3 Peak": 1, "H3K4me3 Pvalue": 0.001},
+        {"seqnames": "chr1", "start": 600, "end": 800, "H3K4me3 Peak": 0, "H3K4me3 Pvalue": 0.3},
+        {"seqnames": "chr2", "start": 0, "end": 400, "H3K4me3 Peak": 0, "H3K4me3 Pvalue": 0.2},
+    ])
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
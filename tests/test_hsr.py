@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import pandas as pd
+from sklearn.linear_model import LinearRegression
+from decoden.denoising.hsr import run_HSR
+from decoden.constants import UNSPECIFIC_SIGNAL_LABEL
+
+
+def reference_HSR(wmat, bl_mask, conditions_list, eps=1e-20, signal_clip=0.1):
+    control_transf = np.log(np.maximum(wmat[UNSPECIFIC_SIGNAL_LABEL].values, eps))
+    ctrl_bl = control_transf[bl_mask]
+    out_df = pd.DataFrame(index=wmat.index)
+    for treatment_cond in conditions_list[1:]:
+        treatment_transf = np.log(np.maximum(wmat[treatment_cond].values, eps))
+        treat_bl = treatment_transf[bl_mask]
+        fit_mask = (ctrl_bl > np.median(ctrl_bl)) & (treat_bl > np.median(treat_bl))
+        reg = LinearRegression(fit_intercept=False).fit(ctrl_bl[fit_mask].reshape(-1, 1), treat_bl[fit_mask])
+        log_pred = np.maximum(reg.predict(control_transf.reshape(-1, 1)), np.log(signal_clip))
+        out_df[treatment_cond+" HSR Value"] = np.exp(treatment_transf - log_pred)
+    return out_df
+
+
+def test_run_HSR_matches_linear_regression():
+    rng = np.random.default_rng(0)
+    n_bins = 200
+    control = rng.gamma(5.0, 2.0, n_bins)
+    wmat = pd.DataFrame({
+        UNSPECIFIC_SIGNAL_LABEL: control,
+        "H3K4me3": 1.5*control*rng.gamma(20.0, 0.05, n_bins),
+        "H3K27me3": 0.8*control*rng.gamma(20.0, 0.05, n_bins),
+    }, index=pd.MultiIndex.from_arrays([["chr1"]*n_bins, np.arange(n_bins)*200, np.arange(1, n_bins+1)*200]))
+    bl_mask = np.zeros(n_bins, dtype=bool)
+    bl_mask[::3] = True
+    conditions_list = ["control", "H3K4me3", "H3K27me3"]
+
+    result = run_HSR(wmat, bl_mask, conditions_list)
+    expected = reference_HSR(wmat, bl_mask, conditions_list)
+
+    assert list(result.columns) == list(expected.columns)
+    assert result.index.equals(wmat.index)
+    np.testing.assert_allclose(result.values, expected.values, rtol=1e-6)
+
+
+def test_run_HSR_raises_on_empty_fit():
+    n_bins = 50
+    wmat = pd.DataFrame({UNSPECIFIC_SIGNAL_LABEL: np.zeros(n_bins), "H3K4me3": np.arange(n_bins, dtype=float)})
+    bl_mask = np.ones(n_bins, dtype=bool)
+
+    with pytest.raises(ValueError, match="H3K4me3"):
+        run_HSR(wmat, bl_mask, ["control", "H3K4me3"])
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+from decoden.denoising.nmf import extract_mixing_matrix, extract_signal
+
+
+def make_data(n_bins=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.gamma(2.0, 2.0, n_bins)
+    treatments = {"H3K4me3": base + rng.gamma(0.5, 4.0, n_bins), "H3K27me3": 1.5*base + rng.gamma(0.3, 6.0, n_bins)}
+    columns = {f"control_{rep}": rng.poisson(base) + 0.01 for rep in range(2)}
+    for condition, signal in treatments.items():
+        columns.update({f"{condition}_{rep}": rng.poisson(signal) for rep in range(2)})
+    data_df = pd.DataFrame(columns).astype(float)
+    conditions_list = ["control", "H3K4me3", "H3K27me3"]
+    conditions_counts = {"control": 2, "H3K4me3": 2, "H3K27me3": 2}
+    return data_df, conditions_list, conditions_counts
+
+
+def test_extract_mixing_matrix_parallel_matches_serial():
+    data_df, conditions_list, conditions_counts = make_data()
+    kwargs = dict(control_cov_threshold=0.5, n_train_bins=1000, seed=0)
+
+    serial = extract_mixing_matrix(data_df, conditions_list, conditions_counts, n_jobs=1, **kwargs)
+    parallel = extract_mixing_matrix(data_df, conditions_list, conditions_counts, n_jobs=2, **kwargs)
+
+    assert serial.index.equals(parallel.index)
+    assert serial.columns.equals(parallel.columns)
+    np.testing.assert_allclose(parallel.values, serial.values, rtol=1e-5, atol=1e-7)
+
+
+@pytest.mark.parametrize("chunk_size", [20, 100])
+def test_extract_signal_chunks(chunk_size):
+    data_df, conditions_list, _ = make_data(n_bins=53)
+    rng = np.random.default_rng(1)
+    mmatrix = pd.DataFrame(rng.uniform(0.1, 1.0, (len(conditions_list), data_df.shape[1])), columns=data_df.columns)
+
+    result = extract_signal(data_df, mmatrix, conditions_list, chunk_size=chunk_size)
+
+    assert result.shape == (len(data_df), len(conditions_list))
+    assert result.index.equals(data_df.index)
+    assert np.isfinite(result.values).all() and (result.values >= 0).all()
+    # The last, shorter chunk must be filled with the fit of its own rows
+    last_start = (len(data_df) - 1) // chunk_size * chunk_size
+    last_chunk = extract_signal(data_df.iloc[last_start:], mmatrix, conditions_list, chunk_size=chunk_size)
+    np.testing.assert_array_equal(result.values[last_start:], last_chunk.values)
@@ -1,8 +1,11 @@
 import pytest
 import json
+import time
+import numpy as np
 from os.path import join, exists
 
 from decoden.main import *
+import decoden.preprocessing.pipeline as preprocessing_pipeline
 
 
 def test_output_files_created(tmp_session_directory, correct_csv):
@@ -20,3 +23,21 @@ def test_output_files_created(tmp_session_directory, correct_csv):
         experiment_conditions = json.load(f)
     for k in experiment_conditions.keys():
         assert exists(join(out_dir, k))
+
+
+def test_experiment_conditions_order_with_parallel_jobs(tmp_path, correct_csv, monkeypatch):
+    # Make the first treatment condition finish last, so completion order differs from group order
+    def fake_fragment_length(list_of_filepaths, output_dir, genome_size, rfile='predictd'):
+        time.sleep(0.3 if rfile.startswith("h3k27me3") else 0.0)
+        return 200
+    monkeypatch.setattr(preprocessing_pipeline, "get_fragment_length", fake_fragment_length)
+    monkeypatch.setattr(preprocessing_pipeline.Preprocessor, "init_chrom_sizes", lambda self: None)
+    monkeypatch.setattr(preprocessing_pipeline.Preprocessor, "count_reads",
+                        lambda self, list_of_filepaths, fragment_length, is_control: np.ones(10))
+
+    preprocess_object = preprocessing_pipeline.Preprocessor(correct_csv, 200, 2, str(tmp_path), "hs")
+    preprocess_object.run()
+
+    with open(join(tmp_path, "experiment_conditions.json"), "r") as f:
+        experiment_conditions = json.load(f)
+    assert [v["condition"] for v in experiment_conditions.values()] == ["control", "h3k27me3", "h3k4me3"]